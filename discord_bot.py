@@ -2,269 +2,479 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import asyncio
+import hashlib
+import hmac
 import aiohttp
+from aiohttp import web
 import json
+import orjson
 import os
 import time
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.containerinstance import ContainerInstanceManagementClient
+from functools import cached_property
 import logging
-from typing import Optional
+import traceback
+
+try:
+    import uvloop  # Event loop basado en libuv, no disponible en Windows
+except ImportError:
+    uvloop = None
 
 # Configuración
 RESOURCE_GROUP = "minecraft-rg"
 CONTAINER_NAME = "minecraft-server"
 SUBSCRIPTION_ID = "39626f70-6824-4598-96f7-cd57f0f39206"
+ARM_SCOPE = "https://management.azure.com/.default"
+CONTAINER_GROUP_URL = (
+    f"https://management.azure.com/subscriptions/{SUBSCRIPTION_ID}"
+    f"/resourceGroups/{RESOURCE_GROUP}/providers/Microsoft.ContainerInstance"
+    f"/containerGroups/{CONTAINER_NAME}?api-version=2023-05-01"
+)
+# Webhook de Event Grid (opcional): avisa al bot cuando el contenedor cambia de estado
+EVENTGRID_WEBHOOK_PORT = os.getenv('EVENTGRID_WEBHOOK_PORT')
+EVENTGRID_WEBHOOK_KEY = os.getenv('EVENTGRID_WEBHOOK_KEY')
+# Servidor de pruebas: si está definido, los comandos se sincronizan solo ahí (instantáneo)
+DEBUG_GUILD = os.getenv('DEBUG_GUILD')
+# SYNC_COMMANDS=1 fuerza la sincronización global al iniciar, SYNC_COMMANDS=0 la omite;
+# sin definir, solo se sincroniza si los comandos cambiaron desde la última vez
+SYNC_COMMANDS = os.getenv('SYNC_COMMANDS')
+# Huella de los comandos sincronizados globalmente por última vez
+COMMANDS_LOCK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "commands.lock")
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
+_log = logging.getLogger(__name__)
 
-# Configurar intents del bot
+# Configurar intents del bot (sin message_content: solo se usan comandos slash)
 intents = discord.Intents.default()
-intents.message_content = True
+
+class MinecraftBot(commands.Bot):
+    async def close(self):
+        # Cerrar el webhook y liberar las conexiones con Azure antes de cerrar el bot
+        if _webhook_runner is not None:
+            await _webhook_runner.cleanup()
+        if _manager is not None:
+            await _manager.close()
+        await super().close()
 
 # Crear bot con soporte para comandos slash
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = MinecraftBot(command_prefix=commands.when_mentioned, intents=intents)
 tree = bot.tree
 
 class MinecraftManager:
     def __init__(self):
-        # Configurar credenciales para Railway/Render
-        if os.getenv('AZURE_CLIENT_ID'):
-            # Usar Service Principal si está configurado
-            from azure.identity import ClientSecretCredential
-            self.credential = ClientSecretCredential(
-                tenant_id=os.getenv('AZURE_TENANT_ID'),
-                client_id=os.getenv('AZURE_CLIENT_ID'),
-                client_secret=os.getenv('AZURE_CLIENT_SECRET')
+        # El SDK de Azure se importa aquí para no cargarlo al importar el módulo
+        from azure.identity.aio import (
+            AzureCliCredential,
+            ChainedTokenCredential,
+            EnvironmentCredential,
+            ManagedIdentityCredential,
+        )
+        
+        # Solo las fuentes que aplican, en lugar de toda la cadena de DefaultAzureCredential:
+        # - EnvironmentCredential: Service Principal de Railway/Render (AZURE_CLIENT_ID con secreto o certificado)
+        # - ManagedIdentityCredential: identidad administrada en Azure (App Service, VMs, AKS vía IMDS)
+        # - AzureCliCredential: desarrollo local con `az login`
+        # Se prueban en orden en la primera petición de token, no al crear el manager
+        self.credential = ChainedTokenCredential(
+            EnvironmentCredential(),
+            ManagedIdentityCredential(),
+            AzureCliCredential()
+        )
+        
+        # Token de ARM para las llamadas REST directas, se renueva antes de expirar
+        self._arm_token = None
+        
+        # Caché corta del estado para no repetir llamadas a ARM en el mismo comando
+        self._status_cache = None
+        self._status_cache_ts = 0.0
+        self._status_ttl = 2.0
+        # Consulta en curso compartida por todas las llamadas concurrentes
+        self._status_inflight = None
+        # Eventos de las esperas activas, se activan al recibir un aviso de Event Grid
+        self._state_waiters = set()
+        # Operaciones de inicio/detención en curso, para no repetirlas contra ARM
+        self._start_task = None
+        self._stop_task = None
+        
+        self._http_session = None
+    
+    @property
+    def http_session(self):
+        """Sesión aiohttp compartida, creada dentro del event loop en el primer uso"""
+        if self._http_session is None:
+            # keepalive largo: sin él, la primera llamada tras ~15s de inactividad
+            # vuelve a pagar el handshake TCP+TLS con ARM
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=300, ttl_dns_cache=300)
             )
+        return self._http_session
+    
+    @cached_property
+    def container_client(self):
+        """Cliente asíncrono de ARM creado en el primer uso, con conexiones reutilizables"""
+        from azure.core.pipeline.transport import AioHttpTransport
+        from azure.mgmt.containerinstance.aio import ContainerInstanceManagementClient
+        
+        transport = AioHttpTransport(session=self.http_session, session_owner=False)
+        return ContainerInstanceManagementClient(self.credential, SUBSCRIPTION_ID, transport=transport)
+    
+    async def _get_arm_token(self):
+        """Devuelve el token de ARM en caché, pidiendo uno nuevo si faltan menos de 5 minutos"""
+        if self._arm_token is None or self._arm_token.expires_on - 300 < time.time():
+            self._arm_token = await self.credential.get_token(ARM_SCOPE)
+        return self._arm_token.token
+    
+    async def _get_status_raw(self):
+        """Lee el estado directamente de la API REST de ARM, sin deserializar el modelo completo"""
+        for _ in range(2):
+            token = await self._get_arm_token()
+            headers = {"Authorization": f"Bearer {token}"}
+            async with self.http_session.get(CONTAINER_GROUP_URL, headers=headers) as resp:
+                if resp.status == 401:
+                    # Token revocado o caducado antes de tiempo: pedir uno nuevo y reintentar
+                    self._arm_token = None
+                    continue
+                resp.raise_for_status()
+                data = orjson.loads(await resp.read())
+                break
         else:
-            # Usar DefaultAzureCredential para desarrollo local
-            self.credential = DefaultAzureCredential()
+            raise PermissionError("ARM rechazó el token tras renovarlo")
         
-        self.container_client = ContainerInstanceManagementClient(self.credential, SUBSCRIPTION_ID)
+        properties = data.get("properties", {})
+        instance_view = properties.get("instanceView") or {}
+        ip_address = properties.get("ipAddress") or {}
+        return {
+            "status": instance_view.get("state", "Unknown"),
+            "ip_address": ip_address.get("ip", "No IP"),
+            "name": data.get("name")
+        }
+    
+    async def close(self):
+        """Cierra el cliente de ARM, la sesión HTTP y la credencial"""
+        if "container_client" in self.__dict__:
+            await self.container_client.close()
+            del self.container_client
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+        await self.credential.close()
     
-    def _get_server_status_sync(self):
-        """Versión síncrona de get_server_status para ejecutar en un hilo separado"""
+    async def _fetch_server_status(self):
+        """Consulta a ARM el estado del contenedor"""
         try:
-            container = self.container_client.container_groups.get(RESOURCE_GROUP, CONTAINER_NAME)
-            status = container.instance_view.state if container.instance_view else "Unknown"
-            ip_address = container.ip_address.ip if container.ip_address else "No IP"
-            return {"status": status, "ip_address": ip_address, "name": container.name}
+            return await self._get_status_raw()
         except Exception as e:
-            logging.error(f"Error getting server status: {e}")
+            _log.error("Error getting server status: %s", e)
             return None
             
-    async def get_server_status(self):
-        """Obtiene el estado actual del servidor"""
-        return await self._run_in_executor(self._get_server_status_sync)
+    async def get_server_status(self, force=False):
+        """Obtiene el estado actual del servidor (force=True ignora la caché)"""
+        if not force and self._status_cache and time.monotonic() - self._status_cache_ts < self._status_ttl:
+            return self._status_cache
+        
+        # Si ya hay una consulta en curso, esperar su resultado en lugar de repetirla
+        if self._status_inflight is not None:
+            return await asyncio.shield(self._status_inflight)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._status_inflight = future
+        status_info = None
+        try:
+            status_info = await self._fetch_server_status()
+            if status_info:
+                self._status_cache = status_info
+                self._status_cache_ts = time.monotonic()
+        finally:
+            self._status_inflight = None
+            future.set_result(status_info)
+        return status_info
     
-    async def _run_in_executor(self, func, *args):
-        """Ejecuta una función síncrona en un ejecutor de hilos"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, func, *args)
+    def invalidate_status(self):
+        """Descarta el estado en caché tras modificar el contenedor"""
+        self._status_cache = None
+        self._status_cache_ts = 0.0
+    
+    def notify_state_change(self):
+        """Despierta a las esperas activas cuando Azure avisa de un cambio en el contenedor"""
+        self.invalidate_status()
+        for changed in self._state_waiters:
+            changed.set()
 
-    def _start_server_sync(self):
-        """Versión síncrona de start_server para ejecutar en un hilo separado"""
+    @property
+    def is_starting(self):
+        """Indica si hay un inicio en curso (desde begin_start hasta que el servidor está listo)"""
+        return self._start_task is not None and not self._start_task.done()
+    
+    async def _start_server(self, on_change=None, initial_status=None, timeout=180):
+        """
+        Inicia el contenedor y espera a que esté listo para jugar.
+        Devuelve el estado final, None si no estuvo listo a tiempo o False si ARM rechazó el inicio
+        """
         try:
-            operation = self.container_client.container_groups.begin_start(
+            poller = await self.container_client.container_groups.begin_start(
                 resource_group_name=RESOURCE_GROUP,
-                container_group_name=CONTAINER_NAME
+                container_group_name=CONTAINER_NAME,
+                # Ignorar el Retry-After de ARM (30-60s): con 2s, un arranque de 5 minutos
+                # consume ~150 de las 15.000 lecturas/hora de la suscripción
+                polling_interval=2
             )
-            result = operation.result()
-            return True
         except Exception as e:
-            logging.error(f"Error al iniciar el servidor: {e}")
+            _log.error("Error al iniciar el servidor: %s", e)
             return False
+        finally:
+            self.invalidate_status()
+        
+        # El poller asíncrono solo consulta a ARM mientras se espera su resultado, así que corre
+        # junto a la espera del estado: detecta fallos de la operación y, al terminar, despierta la espera
+        operation = asyncio.ensure_future(poller.result())
+        operation.add_done_callback(lambda _: self.notify_state_change())
+        # Esperar con backoff corto (1s, 1.5s, 2.25s... hasta 8s) para avisar en cuanto tenga IP
+        ready = asyncio.ensure_future(self.wait_for_state(
+            lambda info: info["status"] == "Running" and info["ip_address"] != "No IP",
+            timeout=timeout, base=1.0, factor=1.5, cap=8.0,
+            on_change=on_change, initial_status=initial_status
+        ))
+        try:
+            await asyncio.wait({operation, ready}, return_when=asyncio.FIRST_COMPLETED)
+            if operation.done() and not operation.cancelled() and operation.exception():
+                _log.error("Error al iniciar el servidor: %s", operation.exception())
+                return False
+            return await ready
+        finally:
+            operation.cancel()
+            ready.cancel()
             
-    async def start_server(self):
-        """Inicia el servidor de Minecraft"""
-        return await self._run_in_executor(self._start_server_sync)
+    async def start_server(self, on_change=None, initial_status=None):
+        """
+        Inicia el servidor de Minecraft y espera a que esté listo. Mientras dura, las demás
+        llamadas se unen a la misma operación en lugar de repetir el inicio contra ARM
+        """
+        if self._start_task is None or self._start_task.done():
+            self._start_task = asyncio.create_task(self._start_server(on_change, initial_status))
+        return await asyncio.shield(self._start_task)
     
-    def _stop_server_sync(self):
-        """Versión síncrona de stop_server para ejecutar en un hilo separado"""
+    async def _stop_server(self, timeout=30):
+        """
+        Detiene el contenedor si está en ejecución y espera a confirmarlo.
+        Devuelve el estado final, None si no se confirmó a tiempo o False si falló
+        """
         try:
-            # Primero intentamos detener el contenedor usando la API de reinicio con estado detenido
-            container = self.container_client.container_groups.get(
+            container = await self.container_client.container_groups.get(
                 resource_group_name=RESOURCE_GROUP,
                 container_group_name=CONTAINER_NAME
             )
             
-            # Si el contenedor ya está detenido, no hacemos nada
-            if container.instance_view and container.instance_view.state.lower() != 'running':
-                return True
-                
-            # Detener el contenedor
-            self.container_client.container_groups.stop(
-                resource_group_name=RESOURCE_GROUP,
-                container_group_name=CONTAINER_NAME
-            )
-            
-            # Verificar que se detuvo
-            max_attempts = 12
-            for _ in range(max_attempts):
-                container = self.container_client.container_groups.get(
+            # Detener el contenedor solo si sigue en ejecución
+            if not container.instance_view or container.instance_view.state.lower() == 'running':
+                await self.container_client.container_groups.stop(
                     resource_group_name=RESOURCE_GROUP,
                     container_group_name=CONTAINER_NAME
                 )
-                if container.instance_view and container.instance_view.state.lower() != 'running':
-                    return True
-                import time
-                time.sleep(5)
-                
-            logging.warning("El contenedor no se detuvo en el tiempo esperado")
-            return False
             
         except Exception as e:
-            logging.error(f"Error al detener el servidor: {e}")
+            _log.error("Error al detener el servidor: %s", e)
             return False
+        finally:
+            self.invalidate_status()
+        
+        # Verificar que se detuvo correctamente
+        return await self.wait_for_state(lambda info: info["status"] != "Running", timeout=timeout)
             
     async def stop_server(self):
-        """Detiene el servidor de Minecraft"""
-        return await self._run_in_executor(self._stop_server_sync)
+        """Detiene el servidor de Minecraft y espera a confirmarlo (las llamadas concurrentes comparten la operación)"""
+        if self._stop_task is None or self._stop_task.done():
+            self._stop_task = asyncio.create_task(self._stop_server())
+        return await asyncio.shield(self._stop_task)
 
-# Instancia del manager
-minecraft_manager = MinecraftManager()
+    async def wait_for_state(self, condition, timeout=180, base=2.0, factor=2.0, cap=30.0, on_change=None, initial_status=None):
+        """
+        Espera con backoff exponencial truncado a que el estado cumpla la condición.
+        initial_status es el estado que el llamador ya muestra, para no notificarlo otra vez
+        """
+        deadline = time.monotonic() + timeout
+        delay = base
+        last_status = initial_status
+        changed = asyncio.Event()
+        self._state_waiters.add(changed)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Con los valores por defecto: 2s, 4s, 8s, 16s, 30s... o antes si llega un evento de Azure
+                try:
+                    await asyncio.wait_for(changed.wait(), min(delay, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+                status_info = await self.get_server_status(force=True)
+                if status_info and condition(status_info):
+                    return status_info
+                # Notificar solo cuando el estado cambia, no en cada intento
+                if on_change and status_info and status_info["status"] != last_status:
+                    last_status = status_info["status"]
+                    # Un fallo al notificar (p. ej. el mensaje de progreso se borró) no debe
+                    # cortar la espera, que puede ser compartida con otros llamadores
+                    try:
+                        await on_change(status_info)
+                    except Exception:
+                        _log.exception("Error notificando el cambio de estado")
+                delay = min(cap, delay * factor)
+        finally:
+            self._state_waiters.discard(changed)
+
+# Instancia del manager, creada en el primer comando que la necesite
+_manager = None
+
+def get_manager():
+    """Devuelve el manager de Minecraft, creándolo (y sus credenciales) en el primer uso"""
+    global _manager
+    if _manager is None:
+        _manager = MinecraftManager()
+    return _manager
+
+# Plantillas del embed de /statusminecraft en el formato de Embed.to_dict()
+_STOPPED_EMBED_DICT = {
+    "type": "rich",
+    "title": "🎮 Estado del Servidor Minecraft",
+    "color": 0xff0000,
+    "fields": [
+        {"name": "Estado", "value": "", "inline": True},
+        {"name": "IP", "value": "📡 minecraftsanti.eastus.azurecontainer.io", "inline": True},
+        {"name": "Puerto", "value": "🔌 25565", "inline": True},
+    ],
+}
+_RUNNING_EMBED_DICT = {
+    **_STOPPED_EMBED_DICT,
+    "color": 0x00ff00,
+    "fields": _STOPPED_EMBED_DICT["fields"] + [
+        {"name": "Conectar", "value": "`minecraftsanti.eastus.azurecontainer.io:25565`", "inline": False},
+    ],
+}
+
+async def _reply(interaction: discord.Interaction, **kwargs):
+    """Responde a una interacción ya diferida"""
+    return await interaction.followup.send(**kwargs)
 
 async def check_server_status(interaction: discord.Interaction):
     """Verifica el estado del servidor y devuelve la información"""
-    # Solo diferir la respuesta si no se ha respondido aún
-    if not interaction.response.is_done():
-        await interaction.response.defer()
-    
-    status_info = await minecraft_manager.get_server_status()
+    status_info = await get_manager().get_server_status()
     
     if not status_info:
-        if interaction.response.is_done():
-            await interaction.followup.send("❌ Error al verificar el estado del servidor")
-        else:
-            await interaction.response.send_message("❌ Error al verificar el estado del servidor")
+        await _reply(interaction, content="❌ Error al verificar el estado del servidor")
         return None
         
     return status_info
 
-@bot.tree.command(name="statusminecraft", description="Muestra el estado del servidor de Minecraft")
 @app_commands.describe()
 @app_commands.guild_only()
 async def server_status(interaction: discord.Interaction):
     """Comando para ver el estado del servidor"""
-    await interaction.response.defer()
+    await interaction.response.defer(thinking=True)
     
     status_info = await check_server_status(interaction)
     if not status_info:
         return
     
-    embed = discord.Embed(
-        title="🎮 Estado del Servidor Minecraft",
-        color=0x00ff00 if status_info["status"] == "Running" else 0xff0000
-    )
-    
-    status_emoji = "🟢" if status_info["status"] == "Running" else "🔴"
-    embed.add_field(name="Estado", value=f"{status_emoji} {status_info['status']}", inline=True)
-    embed.add_field(name="IP", value=f"📡 minecraftsanti.eastus.azurecontainer.io", inline=True)
-    embed.add_field(name="Puerto", value="🔌 25565", inline=True)
-    
-    if status_info["status"] == "Running":
-        embed.add_field(name="Conectar", value=f"`minecraftsanti.eastus.azurecontainer.io:25565`", inline=False)
+    running = status_info["status"] == "Running"
+    template = _RUNNING_EMBED_DICT if running else _STOPPED_EMBED_DICT
+    # Solo el campo "Estado" cambia entre llamadas; el resto se toma de la plantilla
+    fields = list(template["fields"])
+    fields[0] = {**fields[0], "value": f"{'🟢' if running else '🔴'} {status_info['status']}"}
+    embed = discord.Embed.from_dict({**template, "fields": fields})
 
-    await interaction.followup.send(embed=embed)
+    await _reply(interaction, embed=embed)
+
+# Referencias a las tareas en segundo plano para que no las recoja el GC antes de terminar
+_background_tasks = set()
+
+async def _watch_until_running(progress_message: discord.WebhookMessage, progress_embed: discord.Embed, initial_status=None):
+    """Inicia el servidor y actualiza el embed de progreso hasta que esté listo"""
+    async def show_progress(info):
+        # Un solo edit por transición de estado para no gastar el rate limit de Discord
+        progress_embed.set_field_at(0, name="Estado", value=f"⏳ {info['status']}", inline=True)
+        await progress_message.edit(embed=progress_embed)
+    
+    try:
+        # El embed ya muestra initial_status: solo se edita cuando el estado cambie
+        status_info = await get_manager().start_server(on_change=show_progress, initial_status=initial_status)
+        
+        if status_info is False:
+            progress_embed.title = "❌ Error al iniciar el servidor"
+            progress_embed.description = None
+            progress_embed.color = 0xff0000
+            await progress_message.edit(embed=progress_embed)
+            return
+        
+        progress_embed.clear_fields()
+        if status_info:
+            progress_embed.title = "✅ ¡Servidor Iniciado!"
+            progress_embed.description = None
+            progress_embed.color = 0x00ff00
+            progress_embed.add_field(name="IP del Servidor", value="🔗 `minecraftsanti.eastus.azurecontainer.io`", inline=False)
+            progress_embed.add_field(name="Estado", value="🟢 En línea y listo para jugar", inline=False)
+        else:
+            # Si llegamos aquí, el servidor no se inició a tiempo
+            progress_embed.title = "⚠️ El servidor está tardando más de lo esperado en iniciar"
+            progress_embed.description = "Por favor, verifica el estado en unos minutos."
+        await progress_message.edit(embed=progress_embed)
+    except Exception:
+        _log.exception("Error siguiendo el arranque del servidor")
 
-@bot.tree.command(name="startminecraft", description="Inicia el servidor de Minecraft")
 @app_commands.describe()
 @app_commands.guild_only()
 async def start_server(interaction: discord.Interaction):
     """Comando para iniciar el servidor"""
+    # Responder a Discord antes de cualquier llamada a Azure (límite de 3 segundos)
+    await interaction.response.defer(thinking=True)
+    
     try:
-        # Diferir la respuesta si no se ha respondido
-        if not interaction.response.is_done():
-            await interaction.response.defer()
-        
         # Verificar estado actual
-        status_info = await minecraft_manager.get_server_status()
-        
+        status_info = await check_server_status(interaction)
         if not status_info:
-            if interaction.response.is_done():
-                await interaction.followup.send("❌ Error al verificar el estado del servidor")
-            else:
-                await interaction.response.send_message("❌ Error al verificar el estado del servidor")
             return
         
         if status_info["status"] == "Running":
             msg = "⚠️ El servidor ya está en ejecución"
-            if interaction.response.is_done():
-                await interaction.followup.send(msg)
-            else:
-                await interaction.response.send_message(msg)
+            await _reply(interaction, content=msg)
             return
         
-        # Enviar mensaje inicial
-        msg = "🚀 Iniciando servidor de Minecraft... Esto puede tomar unos minutos."
-        if interaction.response.is_done():
-            await interaction.followup.send(msg)
-        else:
-            await interaction.response.send_message(msg)
-        
-        # Iniciar el servidor
-        success = await minecraft_manager.start_server()
-        
-        if not success:
-            if interaction.response.is_done():
-                await interaction.followup.send("❌ Error al iniciar el servidor")
-            else:
-                await interaction.response.send_message("❌ Error al iniciar el servidor")
+        # Otro /startminecraft ya lanzó el inicio y está mostrando su progreso
+        if get_manager().is_starting:
+            msg = "⏳ El servidor ya se está iniciando, sigue el progreso en el mensaje anterior"
+            await _reply(interaction, content=msg)
             return
         
-        # Esperar y verificar el estado varias veces
-        max_attempts = 12  # 12 intentos * 10 segundos = 2 minutos
-        for attempt in range(max_attempts):
-            await asyncio.sleep(10)  # Esperar 10 segundos entre intentos
-            status_info = await minecraft_manager.get_server_status()
-            
-            if status_info and status_info["status"] == "Running" and status_info["ip_address"] != "No IP":
-                msg = (f"✅ **¡Servidor Iniciado!**\n\n"
-                      f"🔗 **IP del Servidor:** `minecraftsanti.eastus.azurecontainer.io`\n"
-                      f"🟢 **Estado:** En línea y listo para jugar")
-                
-                if interaction.response.is_done():
-                    await interaction.followup.send(msg)
-                else:
-                    await interaction.response.send_message(msg)
-                return
+        # Un único embed de progreso que se edita durante todo el arranque
+        progress_embed = discord.Embed(
+            title="🚀 Iniciando servidor de Minecraft",
+            description="Esto puede tomar unos minutos.",
+            color=0xffaa00
+        )
+        progress_embed.add_field(name="Estado", value=f"⏳ {status_info['status']}", inline=True)
+        progress_message = await _reply(interaction, embed=progress_embed)
         
-        # Si llegamos aquí, el servidor no se inició correctamente
-        msg = "⚠️ El servidor está tardando más de lo esperado en iniciar. Por favor, verifica el estado en unos minutos."
-        if interaction.response.is_done():
-            await interaction.followup.send(msg)
-        else:
-            await interaction.response.send_message(msg)
+        # El inicio y la espera hasta que esté listo siguen en segundo plano; el comando termina aquí
+        task = asyncio.create_task(_watch_until_running(progress_message, progress_embed, status_info["status"]))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     
     except Exception as e:
-        error_msg = f"❌ Error inesperado: {str(e)}"
-        if interaction.response.is_done():
-            await interaction.followup.send(error_msg)
-        else:
-            await interaction.response.send_message(error_msg)
-        logging.error(f"Error en start_server: {e}")
+        _log.exception("Error en start_server")
+        error_msg = f"❌ Error inesperado: {traceback.format_exception_only(type(e), e)[-1].strip()}"
+        await _reply(interaction, content=error_msg)
 
-@bot.tree.command(name="stopminecraft", description="Detiene el servidor de Minecraft")
 @app_commands.describe()
 @app_commands.guild_only()
 async def stop_server(interaction: discord.Interaction):
     """Comando para detener el servidor"""
+    # Responder a Discord antes de cualquier llamada a Azure (límite de 3 segundos)
+    await interaction.response.defer(thinking=True)
+    
     try:
-        # Diferir la respuesta si no se ha respondido
-        if not interaction.response.is_done():
-            await interaction.response.defer()
-        
         # Verificar estado actual
-        status_info = await minecraft_manager.get_server_status()
-        
+        status_info = await check_server_status(interaction)
         if not status_info:
-            msg = "❌ No se pudo obtener el estado del servidor"
-            if interaction.response.is_done():
-                await interaction.followup.send(msg)
-            else:
-                await interaction.response.send_message(msg)
             return
             
         status_text = "🟢 En línea" if status_info["status"].lower() == "running" else "🔴 Detenido"
@@ -275,82 +485,62 @@ async def stop_server(interaction: discord.Interaction):
             f"📅 **Última actualización:** <t:{int(time.time())}:R>"
         )
         
-        if interaction.response.is_done():
-            await interaction.followup.send(msg)
-        else:
-            await interaction.response.send_message(msg)
-            
-        # Detener el servidor
-        success = await minecraft_manager.stop_server()
+        # Mostrar el estado y detener el servidor a la vez: son operaciones independientes
+        _, status_info = await asyncio.gather(
+            _reply(interaction, content=msg),
+            get_manager().stop_server()
+        )
         
-        if not success:
-            if interaction.response.is_done():
-                await interaction.followup.send("❌ Error al detener el servidor")
-            else:
-                await interaction.response.send_message("❌ Error al detener el servidor")
+        if status_info is False:
+            await _reply(interaction, content="❌ Error al detener el servidor")
             return
         
-        # Verificar que se detuvo correctamente
-        await asyncio.sleep(5)  # Esperar un momento para que se complete la operación
-        status_info = await minecraft_manager.get_server_status()
-        
-        if status_info and status_info["status"] != "Running":
+        if status_info:
             msg = ("✅ **¡Servidor Detenido!**\n\n"
                   "🔴 El servidor de Minecraft ha sido detenido correctamente.")
-            if interaction.response.is_done():
-                await interaction.followup.send(msg)
-            else:
-                await interaction.response.send_message(msg)
+            await _reply(interaction, content=msg)
         else:
             msg = "⚠️ El servidor está tardando en detenerse. Por favor, verifica el estado en unos segundos."
-            if interaction.response.is_done():
-                await interaction.followup.send(msg)
-            else:
-                await interaction.response.send_message(msg)
+            await _reply(interaction, content=msg)
     
     except Exception as e:
-        error_msg = f"❌ Error inesperado: {str(e)}"
-        if interaction.response.is_done():
-            await interaction.followup.send(error_msg)
-        else:
-            await interaction.response.send_message(error_msg)
-        logging.error(f"Error en stop_server: {e}")
+        _log.exception("Error en stop_server")
+        error_msg = f"❌ Error inesperado: {traceback.format_exception_only(type(e), e)[-1].strip()}"
+        await _reply(interaction, content=error_msg)
+
+# Embed de ayuda: su contenido es fijo, se construye una sola vez
+_HELP_EMBED = discord.Embed(
+    title="🎮 Comandos del Bot Minecraft",
+    description="Lista de comandos disponibles (usa `/` para ver los comandos):",
+    color=0x0099ff
+)
+_HELP_EMBED.add_field(
+    name="/statusminecraft", 
+    value="🔍 Muestra el estado actual del servidor", 
+    inline=False
+)
+_HELP_EMBED.add_field(
+    name="/startminecraft", 
+    value="🚀 Inicia el servidor de Minecraft", 
+    inline=False
+)
+_HELP_EMBED.add_field(
+    name="/stopminecraft", 
+    value="⛔ Detiene el servidor de Minecraft", 
+    inline=False
+)
+_HELP_EMBED.add_field(
+    name="/permisos", 
+    value="🔍 Verifica tus permisos en el servidor", 
+    inline=False
+)
 
-@bot.tree.command(name="ayudaminecraft", description="Muestra todos los comandos disponibles para Minecraft")
 @app_commands.describe()
 @app_commands.guild_only()
 async def help_minecraft(interaction: discord.Interaction):
     """Comando de ayuda personalizado"""
-    embed = discord.Embed(
-        title="🎮 Comandos del Bot Minecraft",
-        description="Lista de comandos disponibles (usa `/` para ver los comandos):",
-        color=0x0099ff
-    )
-    
-    embed.add_field(
-        name="/statusminecraft", 
-        value="🔍 Muestra el estado actual del servidor", 
-        inline=False
-    )
-    embed.add_field(
-        name="/startminecraft", 
-        value="🚀 Inicia el servidor de Minecraft", 
-        inline=False
-    )
-    embed.add_field(
-        name="/stopminecraft", 
-        value="⛔ Detiene el servidor de Minecraft", 
-        inline=False
-    )
-    embed.add_field(
-        name="/permisos", 
-        value="🔍 Verifica tus permisos en el servidor", 
-        inline=False
-    )
-    
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await interaction.response.send_message(embed=_HELP_EMBED, ephemeral=True)
 
-@bot.tree.command(name="permisos", description="Verifica los permisos del usuario")
 async def check_permisos(interaction: discord.Interaction):
     """Comando para verificar permisos del usuario"""
     user = interaction.user
@@ -395,7 +585,6 @@ async def check_permisos(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-@bot.tree.command(name="sync", description="[OWNER] Sincronizar comandos manualmente")
 async def sync_commands(interaction: discord.Interaction):
     """Comando para sincronizar comandos manualmente (solo para dueños)"""
     if not await bot.is_owner(interaction.user):
@@ -406,16 +595,122 @@ async def sync_commands(interaction: discord.Interaction):
     
     try:
         synced = await bot.tree.sync()
+        write_commands_lock(get_commands_hash())
         await interaction.followup.send(f"✅ Comandos sincronizados: {len(synced)}\n" + 
                                       "\n".join([f"• /{cmd.name}" for cmd in synced]), ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"❌ Error al sincronizar: {e}", ephemeral=True)
 
+# Comandos slash: (nombre, descripción, callback). Se registran en setup_hook
+SLASH_COMMANDS = [
+    ("statusminecraft", "Muestra el estado del servidor de Minecraft", server_status),
+    ("startminecraft", "Inicia el servidor de Minecraft", start_server),
+    ("stopminecraft", "Detiene el servidor de Minecraft", stop_server),
+    ("ayudaminecraft", "Muestra todos los comandos disponibles para Minecraft", help_minecraft),
+    ("permisos", "Verifica los permisos del usuario", check_permisos),
+    ("sync", "[OWNER] Sincronizar comandos manualmente", sync_commands),
+]
+
+def register_commands():
+    """Registra todos los comandos slash en el árbol del bot"""
+    for name, description, callback in SLASH_COMMANDS:
+        bot.tree.add_command(app_commands.Command(name=name, description=description, callback=callback))
+
+async def handle_azure_event(request: web.Request):
+    """Recibe los eventos de Event Grid sobre el contenedor de Minecraft"""
+    # Comparación en tiempo constante para no filtrar la clave por tiempos de respuesta
+    if not hmac.compare_digest(request.query.get('key', '').encode(), EVENTGRID_WEBHOOK_KEY.encode()):
+        return web.Response(status=401)
+    
+    try:
+        events = orjson.loads(await request.read())
+    except orjson.JSONDecodeError:
+        return web.Response(status=400)
+    
+    # Event Grid siempre envía una lista de eventos (objetos)
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return web.Response(status=400)
+    
+    for event in events:
+        # Handshake de validación al crear la suscripción
+        if event.get("eventType") == "Microsoft.EventGrid.SubscriptionValidationEvent":
+            validation_code = (event.get("data") or {}).get("validationCode")
+            if not validation_code:
+                return web.Response(status=400)
+            return web.json_response({"validationResponse": validation_code})
+        
+        if event.get("subject", "").lower().endswith(f"/containergroups/{CONTAINER_NAME}"):
+            _log.info("Evento de Azure recibido: %s", event.get('data', {}).get('operationName'))
+            # Sin manager no hay ninguna espera activa a la que avisar
+            if _manager is not None:
+                _manager.notify_state_change()
+    
+    return web.Response(status=200)
+
+# Runner del webhook, se libera al cerrar el bot
+_webhook_runner = None
+
+async def start_event_webhook(port):
+    """Levanta el servidor HTTP del webhook en el mismo event loop del bot"""
+    global _webhook_runner
+    app = web.Application()
+    app.router.add_post("/azure/events", handle_azure_event)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    _webhook_runner = runner
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    print(f"📡 Webhook de Event Grid escuchando en el puerto {port}")
+
+def get_commands_hash():
+    """
+    Calcula una huella de los comandos registrados para detectar cambios.
+    Incluye la aplicación de Discord, para que otro bot con el mismo código (p. ej. uno de pruebas) sí se sincronice
+    """
+    signature = [
+        (
+            cmd.qualified_name,
+            cmd.description,
+            getattr(cmd, "guild_only", False),
+            [(param.name, param.description, param.required) for param in getattr(cmd, "parameters", [])]
+        )
+        for cmd in sorted(bot.tree.walk_commands(), key=lambda c: c.qualified_name)
+    ]
+    return hashlib.sha256(json.dumps([bot.application_id, signature]).encode()).hexdigest()
+
+def read_commands_lock():
+    """Lee la huella de la última sincronización global"""
+    try:
+        with open(COMMANDS_LOCK_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_commands_lock(commands_hash):
+    """Guarda la huella de la última sincronización global"""
+    try:
+        with open(COMMANDS_LOCK_FILE, "w") as f:
+            f.write(commands_hash)
+    except OSError as e:
+        _log.warning("No se pudo guardar %s: %s", COMMANDS_LOCK_FILE, e)
+
 # Sincronizar comandos al iniciar
 @bot.event
 async def setup_hook():
+    if EVENTGRID_WEBHOOK_PORT:
+        # El endpoint es público: sin clave cualquiera podría validar suscripciones o enviar eventos
+        if EVENTGRID_WEBHOOK_KEY:
+            # El webhook es opcional: si no arranca, las esperas siguen funcionando por sondeo
+            try:
+                await start_event_webhook(int(EVENTGRID_WEBHOOK_PORT))
+            except Exception as e:
+                _log.warning("No se pudo iniciar el webhook de Event Grid (%s), se usará solo el sondeo", e)
+        else:
+            print("⚠️ EVENTGRID_WEBHOOK_PORT requiere EVENTGRID_WEBHOOK_KEY, el webhook no se inicia")
+    
     print("🔄 Configurando comandos...")
     try:
+        register_commands()
+        
         # NO limpiar comandos, solo configurar permisos y sincronizar
         print("⚙️ Configurando permisos por defecto...")
         
@@ -426,8 +721,24 @@ async def setup_hook():
             print(f"  🔧 Configurado: /{command.name}")
         
         # Sincronizar comandos
-        print("🔄 Sincronizando comandos...")
-        synced = await bot.tree.sync()
+        if DEBUG_GUILD:
+            # En desarrollo, sincronizar solo con el servidor de pruebas
+            print(f"🔄 Sincronizando comandos con el servidor de pruebas {DEBUG_GUILD}...")
+            guild = discord.Object(id=int(DEBUG_GUILD))
+            bot.tree.copy_global_to(guild=guild)
+            synced = await bot.tree.sync(guild=guild)
+        elif SYNC_COMMANDS == "0":
+            print("⏭️ SYNC_COMMANDS=0, se omite la sincronización (usa /sync si hace falta)")
+            return
+        else:
+            commands_hash = get_commands_hash()
+            if SYNC_COMMANDS != "1" and read_commands_lock() == commands_hash:
+                print("✅ Los comandos no han cambiado, se omite la sincronización global")
+                return
+            
+            print("🔄 Sincronizando comandos...")
+            synced = await bot.tree.sync()
+            write_commands_lock(commands_hash)
         print(f"✅ {len(synced)} comandos sincronizados correctamente")
         
         # Mostrar información de cada comando registrado
@@ -436,7 +747,6 @@ async def setup_hook():
             
     except Exception as e:
         print(f"❌ Error durante la sincronización: {e}")
-        import traceback
         traceback.print_exc()
 
 @bot.event
@@ -452,7 +762,7 @@ async def on_command_error(ctx, error):
         # No responder a comandos con prefijo, ya que ahora usamos comandos slash
         return
     await ctx.send(f"❌ Error: {str(error)}")
-    logging.error(f"Command error: {error}")
+    _log.error("Command error: %s", error)
 
 if __name__ == "__main__":
     # El token debe estar en una variable de entorno
@@ -463,6 +773,9 @@ if __name__ == "__main__":
         print("🔧 Configura la variable de entorno DISCORD_BOT_TOKEN con el token de tu bot")
         exit(1)
     
+    if uvloop:
+        uvloop.install()
+    
     try:
         bot.run(TOKEN)
     except discord.LoginFailure:
@@ -1,145 +1,326 @@
 import azure.functions as func
+import asyncio
+import errno
+import functools
+import itertools
 import json
 import logging
+import re
+import select
 import socket
 import struct
 import time
-from datetime import datetime, timezone
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.containerinstance import ContainerInstanceManagementClient
-from azure.data.tables import TableServiceClient, TableEntity
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.mgmt.containerinstance.aio import ContainerInstanceManagementClient
+from azure.data.tables import TableEntity
+from azure.data.tables.aio import TableServiceClient
 import os
 
 # Configuración
 RESOURCE_GROUP = "minecraft-rg"
 CONTAINER_NAME = "minecraft-server"
 MINECRAFT_PORT = 25565
+CHECK_INTERVAL_MINUTES = 3
 SHUTDOWN_THRESHOLD_MINUTES = 6  # 2 checks de 3 minutos cada uno
+MAX_STATUS_BYTES = 65536  # El JSON de estado incluye el favicon en base64
+LOG_TAIL_LINES = 50  # Líneas del log que se descargan y analizan en cada ejecución
+
+# Patrones de actividad en los logs (itzg/minecraft-server, servidores offline)
+ACTIVITY_PATTERNS = (
+    'joined the game',
+    'left the game',
+    'logged in with entity id',
+    'lost connection',
+    '[Not Secure]',  # Chat messages en servidores offline
+    'issued server command',
+    'was slain',
+    'drowned',
+    'fell',
+    'has made the advancement',
+    'UUID of player',
+    'moving too quickly',
+    'tried to swim in lava',
+    'went up in flames',
+    'blew up',
+    'hit the ground too hard',
+    'was shot',
+    'was killed',
+    'starved to death',
+    'suffocated',
+    'experienced kinetic energy',
+    'fell out of the world',
+    'saving chunks',  # Indica actividad del servidor
+    'automatic saving',
+    'ThreadedAnvilChunkStorage'  # Actividad de guardado
+)
+CONNECTION_PATTERNS = ('connection', 'disconnect', 'timeout', 'handshake')
+
+# Compilados una sola vez y aplicados sobre el texto completo de la cola del log,
+# de modo que el recorrido línea a línea lo hace el motor de regex y no un bucle de Python.
+# Los patrones de línea devuelven como mucho una coincidencia (la línea entera) por línea
+_ACTIVITY_LINE_RE = re.compile(
+    r'^.*?(?:' + '|'.join(map(re.escape, ACTIVITY_PATTERNS)) + r').*$', re.IGNORECASE | re.MULTILINE)
+_CONNECTION_LINE_RE = re.compile(
+    r'^.*?(?:' + '|'.join(CONNECTION_PATTERNS) + r').*$', re.IGNORECASE | re.MULTILINE)
+_PLAYER_EVENT_RE = re.compile(
+    r'(\w+)\s+(?:(?P<join>joined the game|logged in)|left the game|lost connection|disconnected)', re.IGNORECASE)
 
 app = func.FunctionApp()
 
+# Clientes (aio) reutilizados entre ejecuciones: el worker de Functions mantiene el módulo y su event loop
+_CRED = None
+_ACI_CLIENTS = {}
+_TABLE_CLIENT = None
+_HTTP_SESSION = None
+_UDP_SOCKS = {}
+
+# Última copia del estado guardado en Table Storage, para no leerlo ni reescribirlo en cada ejecución
+_STATE_CACHE = {}
+_STATE_TRACKED_FIELDS = ("consecutive_empty_checks", "consecutive_failures", "last_successful_protocol")
+
+def get_http_transport():
+    """
+    Devuelve un transporte aiohttp sobre una sesión compartida por todos los clientes de Azure,
+    para que las llamadas de cada ejecución reutilicen las conexiones TLS ya abiertas
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=300, ttl_dns_cache=300)
+        )
+    return AioHttpTransport(session=_HTTP_SESSION, session_owner=False)
+
+def get_aci_client(subscription_id):
+    """
+    Devuelve el cliente de Container Instances para la suscripción,
+    creándolo (junto con la credencial) solo la primera vez
+    """
+    global _CRED
+    client = _ACI_CLIENTS.get(subscription_id)
+    if client is None:
+        if _CRED is None:
+            _CRED = DefaultAzureCredential()
+        client = ContainerInstanceManagementClient(_CRED, subscription_id, transport=get_http_transport())
+        _ACI_CLIENTS[subscription_id] = client
+    return client
+
+_LINGER_RESET = struct.pack('ii', 1, 0)
+
+def create_probe_socket():
+    """
+    Crea el socket TCP de los sondeos: sin Nagle, para que los paquetes pequeños salgan de inmediato,
+    y con SO_LINGER a 0 para que cerrarlo no espere ni deje la conexión en TIME_WAIT
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+    return sock
+
 def test_port_connection(ip_address, port, timeout=5):
-    """Prueba si el puerto está abierto y accesible"""
+    """
+    Abre una conexión TCP no bloqueante con tiempo límite.
+    Devuelve el socket ya conectado (para reutilizarlo en el protocolo) o None
+    """
+    sock = create_probe_socket()
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
+        sock.setblocking(False)
         result = sock.connect_ex((ip_address, port))
-        sock.close()
-        return result == 0
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(result, os.strerror(result))
+        
+        # Esperar a que el socket sea escribible (conexión completada) o al tiempo límite
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable:
+            raise socket.timeout("connect timed out")
+        
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+        
+        sock.settimeout(timeout)
+        return sock
     except Exception as e:
-        logging.debug(f"Port test failed: {e}")
-        return False
+        logging.debug("Port test failed: %s", e)
+        sock.close()
+        return None
 
-def get_minecraft_player_count(ip_address, port=25565, timeout=10):
+def get_minecraft_player_count(ip_address, port=25565, timeout=10, state=None):
     """
     Obtiene el número de jugadores conectados al servidor de Minecraft
-    usando múltiples métodos para máxima compatibilidad
+    usando múltiples métodos para máxima compatibilidad.
+    Si se pasa el estado del monitoreo, prueba primero el último protocolo que funcionó
+    y guarda en él el que responda
     """
-    # Primero verificar si el puerto está abierto
-    if not test_port_connection(ip_address, port, timeout=3):
+    # Primero verificar si el puerto está abierto; la misma conexión se usa para el primer protocolo TCP
+    sock = test_port_connection(ip_address, port, timeout=3)
+    if sock is None:
         logging.warning(f"Port {port} is not accessible on {ip_address}")
         return -1
     
     logging.info(f"Port {port} is open, attempting protocol communication...")
     
-    # Método 1: Protocolo moderno de Minecraft
-    player_count = try_modern_protocol(ip_address, port, timeout)
-    if player_count >= 0:
-        return player_count
+    # Orden por defecto: moderno, legacy (versiones antiguas) y query (si está habilitado)
+    protocols = ["modern", "legacy", "query"]
+    preferred = state.get("last_successful_protocol") if state else None
+    if preferred in protocols:
+        protocols.remove(preferred)
+        protocols.insert(0, preferred)
     
-    # Método 2: Protocolo legacy (versiones más antiguas)
-    player_count = try_legacy_protocol(ip_address, port, timeout)
-    if player_count >= 0:
-        return player_count
-    
-    # Método 3: Query protocol (si está habilitado)
-    player_count = try_query_protocol(ip_address, port, timeout)
-    if player_count >= 0:
-        return player_count
+    try:
+        for protocol in protocols:
+            if protocol == "query":
+                player_count = try_query_protocol(ip_address, port, timeout)
+            else:
+                # El protocolo cierra el socket al terminar; los siguientes abren el suyo
+                player_count = PROTOCOL_HANDLERS[protocol](ip_address, port, timeout, sock=sock)
+                sock = None
+            
+            if player_count >= 0:
+                if state is not None:
+                    state["last_successful_protocol"] = protocol
+                return player_count
+    finally:
+        if sock:
+            sock.close()
     
     logging.warning("All protocol methods failed - server may be starting or using unsupported configuration")
     return -1
 
-def try_modern_protocol(ip_address, port, timeout):
+def _read_varint(sock):
+    """
+    Lee un VarInt de Minecraft byte a byte del socket.
+    Devuelve None si la conexión se cierra antes
+    """
+    value = 0
+    for i in range(5):
+        byte = sock.recv(1)
+        if not byte:
+            return None
+        value |= (byte[0] & 0x7F) << (7 * i)
+        if not byte[0] & 0x80:
+            return value
+    raise ValueError("VarInt too long")
+
+def _recv_exact(sock, size):
+    """
+    Lee exactamente size bytes del socket en un bytearray preasignado.
+    Devuelve None si la conexión se cierra antes
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            return None
+        received += n
+    return buf
+
+def extract_online_players(payload, start=0, end=None):
+    """
+    Extrae el valor de "online" directamente de los bytes del JSON de estado (payload[start:end]).
+    Devuelve None si no lo encuentra, para recurrir al parseo completo
+    """
+    if end is None:
+        end = len(payload)
+    marker = b'"online":'
+    idx = payload.find(marker, start, end)
+    # Ignorar apariciones escapadas dentro de un string (por ejemplo en el MOTD)
+    while idx > start and payload[idx - 1] == 0x5C:  # '\\'
+        idx = payload.find(marker, idx + 1, end)
+    if idx < 0:
+        return None
+    
+    first = idx + len(marker)
+    while first < end and payload[first] in b' \t':
+        first += 1
+    last = first
+    while last < end and 0x30 <= payload[last] <= 0x39:  # dígitos ASCII
+        last += 1
+    if last == first:
+        return None
+    return int(payload[first:last])
+
+@functools.lru_cache(maxsize=4)
+def _build_handshake(ip_address, port):
+    """
+    Construye una sola vez por servidor el handshake seguido del status request.
+    Protocolo 47 (Minecraft 1.8) es muy compatible
+    """
+    server_addr_bytes = ip_address.encode('utf-8')
+    
+    # [packet_length][packet_id=0x00][protocol_version][server_address][server_port][next_state=1]
+    # seguido del status request [length=1][packet_id=0x00]
+    packet = struct.Struct(f'>BBBB{len(server_addr_bytes)}sHBBB')
+    packet_length = 1 + 1 + 1 + len(server_addr_bytes) + 2 + 1
+    return packet.pack(packet_length, 0x00, 47, len(server_addr_bytes), server_addr_bytes, port, 1, 0x01, 0x00)
+
+def try_modern_protocol(ip_address, port, timeout, sock=None):
     """Intenta usar el protocolo moderno de Minecraft con implementación simplificada"""
-    sock = None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        sock.connect((ip_address, port))
+        # Reutilizar la conexión ya abierta si nos la pasan
+        if sock is None:
+            sock = create_probe_socket()
+            sock.settimeout(timeout)
+            sock.connect((ip_address, port))
         
         logging.debug("Connected to server, sending handshake...")
         
-        # Handshake packet más simple y compatible
-        # Protocolo 47 (Minecraft 1.8) es muy compatible
-        server_addr_bytes = ip_address.encode('utf-8')
-        
-        # Construir handshake: [packet_length][packet_id][protocol_version][server_address][server_port][next_state]
-        handshake_data = struct.pack('B', 47)  # Protocol version
-        handshake_data += struct.pack('B', len(server_addr_bytes)) + server_addr_bytes
-        handshake_data += struct.pack('>H', port)
-        handshake_data += struct.pack('B', 1)  # Next state: status
-        
-        # Crear packet completo
-        packet_data = struct.pack('B', 0x00) + handshake_data  # 0x00 = handshake packet ID
-        full_packet = struct.pack('B', len(packet_data)) + packet_data
-        
-        sock.send(full_packet)
-        
-        # Enviar status request
-        status_request = struct.pack('BB', 0x01, 0x00)  # [length=1][packet_id=0x00]
-        sock.send(status_request)
+        # Handshake y status request en un único envío
+        sock.sendall(_build_handshake(ip_address, port))
         
         logging.debug("Handshake and status request sent, waiting for response...")
         
         # Leer respuesta con manejo más robusto
         sock.settimeout(6)
         
-        # Intentar leer la respuesta completa
-        response_data = b''
+        # Leer la respuesta según su encabezado [longitud][packet_id][longitud del JSON]
+        # y después exactamente los bytes del JSON, sin esperar más datos ni el timeout
         try:
-            # Leer hasta 4KB de respuesta
-            while len(response_data) < 4096:
-                chunk = sock.recv(1024)
-                if not chunk:
-                    break
-                response_data += chunk
-                
-                # Si tenemos suficientes datos, intentar parsear
-                if len(response_data) > 10:
-                    try:
-                        # Buscar el JSON en la respuesta
-                        # El JSON típicamente empieza con '{'
-                        json_start = response_data.find(b'{')
-                        if json_start >= 0:
-                            # Encontrar el final del JSON
-                            json_end = response_data.rfind(b'}')
-                            if json_end > json_start:
-                                json_data = response_data[json_start:json_end + 1]
-                                
-                                try:
-                                    server_info = json.loads(json_data.decode('utf-8'))
-                                    players_info = server_info.get('players', {})
-                                    player_count = players_info.get('online', 0)
-                                    max_players = players_info.get('max', 0)
-                                    
-                                    logging.info(f"Modern protocol success: {player_count}/{max_players} players online")
-                                    return player_count
-                                    
-                                except (json.JSONDecodeError, UnicodeDecodeError):
-                                    continue  # Seguir leyendo más datos
-                    except:
-                        continue  # Seguir leyendo
-                        
+            packet_length = _read_varint(sock)
+            _read_varint(sock)  # packet_id
+            json_length = _read_varint(sock)
+            if packet_length is None or json_length is None:
+                logging.debug("Incomplete server response header")
+                return -1
+            if json_length > MAX_STATUS_BYTES or json_length > packet_length:
+                logging.debug("Status response too large or malformed (%s bytes)", json_length)
+                return -1
+            
+            payload = _recv_exact(sock, json_length)
         except socket.timeout:
             logging.debug("Timeout waiting for server response")
-            
-        # Si llegamos aquí, no pudimos parsear la respuesta
-        logging.debug(f"Could not parse server response (got {len(response_data)} bytes)")
-        return -1
+            return -1
+        
+        if payload is None:
+            logging.debug("Incomplete server response (expected %s bytes)", json_length)
+            return -1
+        
+        # Solo necesitamos players.online: buscarlo en los bytes evita decodificar todo el JSON
+        player_count = extract_online_players(payload)
+        if player_count is not None:
+            logging.info(f"Modern protocol success: {player_count} players online")
+            return player_count
+        
+        try:
+            server_info = json.loads(payload)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logging.debug("Could not parse server response (got %s bytes)", json_length)
+            return -1
+        
+        players_info = server_info.get('players', {})
+        player_count = players_info.get('online', 0)
+        max_players = players_info.get('max', 0)
+        
+        logging.info(f"Modern protocol success: {player_count}/{max_players} players online")
+        return player_count
         
     except Exception as e:
-        logging.debug(f"Modern protocol failed: {e}")
+        logging.debug("Modern protocol failed: %s", e)
         return -1
     finally:
         if sock:
@@ -148,56 +329,75 @@ def try_modern_protocol(ip_address, port, timeout):
             except:
                 pass
 
-def try_legacy_protocol(ip_address, port, timeout):
+def _iter_fields(data, start, end, sep=b'\x00', align=1):
+    """
+    Recorre data[start:end] separado por sep y devuelve (inicio, fin) de cada campo sin copiarlo.
+    Con align=2 solo acepta separadores en posiciones pares (nulos UTF-16)
+    """
+    pos = start
+    while True:
+        idx = data.find(sep, pos, end)
+        while idx >= 0 and (idx - start) % align:
+            idx = data.find(sep, idx + 1, end)
+        if idx < 0:
+            yield pos, end
+            return
+        yield pos, idx
+        pos = idx + len(sep)
+
+def try_legacy_protocol(ip_address, port, timeout, sock=None):
     """Intenta usar el protocolo legacy de Minecraft (pre-1.7)"""
-    sock = None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        sock.connect((ip_address, port))
+        # Reutilizar la conexión ya abierta si nos la pasan
+        if sock is None:
+            sock = create_probe_socket()
+            sock.settimeout(timeout)
+            sock.connect((ip_address, port))
         
         # Legacy server list ping
         # Packet: 0xFE 0x01
         packet = struct.pack('BB', 0xFE, 0x01)
-        sock.send(packet)
+        sock.sendall(packet)
         
-        # Leer respuesta
+        # Leer respuesta: [0xFF][longitud del string en caracteres][string UTF-16]
         sock.settimeout(3)
-        response = sock.recv(1024)
-        
-        if len(response) < 3:
-            return -1
+        header = _recv_exact(sock, 3)
         
         # La respuesta debería empezar con 0xFF
-        if response[0] != 0xFF:
+        if header is None or header[0] != 0xFF:
             return -1
         
-        # Leer longitud del string
-        string_length = struct.unpack('>H', response[1:3])[0]
+        # Leer el string completo aunque llegue en varios segmentos
+        string_length = struct.unpack('>H', header[1:3])[0]
+        response = _recv_exact(sock, string_length * 2)
+        if response is None:
+            logging.debug("Legacy response truncated")
+            return -1
         
-        # Leer el string de respuesta
-        string_data = response[3:3 + string_length * 2]  # UTF-16
+        # Localizar los campos del string UTF-16 sin decodificarlo entero (el MOTD puede ser largo)
+        # Formato: §1\x00protocol_version\x00server_version\x00motd\x00current_players\x00max_players
+        fields = list(itertools.islice(_iter_fields(response, 0, len(response), b'\x00\x00', 2), 6))
         
         try:
-            server_info = string_data.decode('utf-16be')
-            # Formato: §1\x00protocol_version\x00server_version\x00motd\x00current_players\x00max_players
-            parts = server_info.split('\x00')
-            
-            if len(parts) >= 5:
-                current_players = int(parts[4])
-                max_players = int(parts[5]) if len(parts) > 5 else 0
+            if len(fields) >= 5:
+                start, end = fields[4]
+                current_players = int(response[start:end].decode('utf-16be'))
+                max_players = 0
+                if len(fields) > 5:
+                    start, end = fields[5]
+                    max_players = int(response[start:end].decode('utf-16be'))
                 
                 logging.info(f"Legacy protocol success: {current_players}/{max_players} players online")
                 return current_players
             
         except (UnicodeDecodeError, ValueError, IndexError) as e:
-            logging.debug(f"Legacy protocol parsing failed: {e}")
+            logging.debug("Legacy protocol parsing failed: %s", e)
             return -1
         
         return -1
         
     except Exception as e:
-        logging.debug(f"Legacy protocol failed: {e}")
+        logging.debug("Legacy protocol failed: %s", e)
         return -1
     finally:
         if sock:
@@ -206,12 +406,35 @@ def try_legacy_protocol(ip_address, port, timeout):
             except:
                 pass
 
+def _get_udp(ip_address, port):
+    """
+    Devuelve un socket UDP ya conectado al servidor, reutilizado entre ejecuciones.
+    Si la IP del contenedor cambió, cierra los sockets anteriores
+    """
+    key = (ip_address, port)
+    sock = _UDP_SOCKS.get(key)
+    if sock is None:
+        for old_key in list(_UDP_SOCKS):
+            _drop_udp(old_key)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(key)
+        _UDP_SOCKS[key] = sock
+    return sock
+
+def _drop_udp(key):
+    """Cierra y olvida el socket UDP cacheado para key"""
+    sock = _UDP_SOCKS.pop(key, None)
+    if sock:
+        try:
+            sock.close()
+        except:
+            pass
+
 def try_query_protocol(ip_address, port, timeout):
     """Intenta usar el query protocol de Minecraft (puerto 25565 + query habilitado)"""
-    sock = None
     try:
-        # Query protocol usa UDP
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Query protocol usa UDP; el socket conectado se conserva entre ejecuciones
+        sock = _get_udp(ip_address, port)
         sock.settimeout(timeout)
         
         # Handshake query
@@ -220,11 +443,12 @@ def try_query_protocol(ip_address, port, timeout):
         session_id = struct.pack('>I', 1)
         
         handshake_packet = magic + packet_type + session_id
-        sock.sendto(handshake_packet, (ip_address, port))
+        sock.send(handshake_packet)
         
         # Recibir token
-        response, addr = sock.recvfrom(1024)
+        response = sock.recv(1024)
         if len(response) < 5:
+            _drop_udp((ip_address, port))
             return -1
         
         # Extraer token
@@ -233,198 +457,147 @@ def try_query_protocol(ip_address, port, timeout):
         # Basic stat query
         packet_type = struct.pack('B', 0x00)  # Stat
         stat_packet = magic + packet_type + session_id + token
-        sock.sendto(stat_packet, (ip_address, port))
+        sock.send(stat_packet)
         
         # Recibir respuesta
-        response, addr = sock.recvfrom(1024)
+        response = sock.recv(1024)
         
         # Parsear respuesta básica
         # Formato: [type][session_id][motd][gametype][map][numplayers][maxplayers][hostport][hostip]
         if len(response) > 5:
-            data = response[5:].split(b'\x00')
-            if len(data) >= 6:
+            # Solo se recorren los separadores hasta el campo maxplayers
+            fields = list(itertools.islice(_iter_fields(response, 5, len(response)), 6))
+            if len(fields) >= 6:
                 try:
-                    current_players = int(data[4].decode('utf-8'))
-                    max_players = int(data[5].decode('utf-8'))
+                    current_players = int(response[fields[4][0]:fields[4][1]])
+                    max_players = int(response[fields[5][0]:fields[5][1]])
                     
                     logging.info(f"Query protocol success: {current_players}/{max_players} players online")
                     return current_players
                     
                 except (ValueError, UnicodeDecodeError, IndexError):
-                    return -1
+                    pass
         
+        # Respuesta inválida: descartar el socket para no leer datagramas sobrantes la próxima vez
+        _drop_udp((ip_address, port))
         return -1
         
     except Exception as e:
-        logging.debug(f"Query protocol failed: {e}")
+        logging.debug("Query protocol failed: %s", e)
+        # Tras un timeout o error el socket puede tener respuestas tardías: abrir uno nuevo la próxima vez
+        _drop_udp((ip_address, port))
         return -1
-    finally:
-        if sock:
-            try:
-                sock.close()
-            except:
-                pass
 
-def get_current_players_from_logs(subscription_id):
+PROTOCOL_HANDLERS = {
+    "modern": try_modern_protocol,
+    "legacy": try_legacy_protocol,
+    "query": try_query_protocol,
+}
+
+def _tail_lines(text, n):
     """
-    Intenta determinar el número actual de jugadores analizando los logs recientes
+    Devuelve las últimas n líneas de text (igual que text.split('\n')[-n:])
+    buscando los saltos de línea desde el final, sin partir el log completo
+    """
+    pos = len(text)
+    for _ in range(n):
+        pos = text.rfind('\n', 0, pos)
+        if pos == -1:
+            return text.split('\n')
+    return text[pos + 1:].split('\n')
+
+async def get_container_logs(subscription_id, tail=LOG_TAIL_LINES):
+    """
+    Descarga una sola vez las últimas líneas de log del contenedor para todos los análisis.
+    Devuelve la lista de líneas, o None si no se pudieron obtener
     """
     try:
-        credential = DefaultAzureCredential()
-        container_client = ContainerInstanceManagementClient(credential, subscription_id)
+        container_client = get_aci_client(subscription_id)
         
-        logs = container_client.containers.list_logs(
+        logs = await container_client.containers.list_logs(
             resource_group_name=RESOURCE_GROUP,
             container_group_name=CONTAINER_NAME,
             container_name=CONTAINER_NAME,
-            tail=100
+            tail=tail
         )
         
         if not logs or not logs.content:
-            return 0
-        
-        log_lines = logs.content.split('\n')
-        
-        # Buscar patrones de conexión/desconexión recientes
-        connected_players = set()
+            return []
         
-        # Revisar las últimas líneas para encontrar jugadores conectados
-        for line in reversed(log_lines[-50:]):  # Últimas 50 líneas
-            line_lower = line.lower()
-            
-            # Buscar conexiones
-            if 'joined the game' in line_lower or 'logged in' in line_lower:
-                # Extraer nombre del jugador
-                import re
-                # Patrones comunes: "Player joined the game" o "[INFO]: Player joined the game"
-                match = re.search(r'(\w+)\s+(?:joined the game|logged in)', line, re.IGNORECASE)
-                if match:
-                    player_name = match.group(1)
-                    connected_players.add(player_name)
-                    logging.debug(f"Found connected player: {player_name}")
-            
-            # Buscar desconexiones
-            elif 'left the game' in line_lower or 'lost connection' in line_lower or 'disconnected' in line_lower:
-                import re
-                match = re.search(r'(\w+)\s+(?:left the game|lost connection|disconnected)', line, re.IGNORECASE)
-                if match:
-                    player_name = match.group(1)
-                    connected_players.discard(player_name)  # Remover si estaba conectado
-                    logging.debug(f"Found disconnected player: {player_name}")
-        
-        player_count = len(connected_players)
-        if player_count > 0:
-            logging.info(f"Estimated {player_count} players from logs: {list(connected_players)}")
-        
-        return player_count
+        # ARM ya devuelve solo la cola pedida; el recorte protege ante un contenido mayor
+        return _tail_lines(logs.content, tail)
         
     except Exception as e:
-        logging.error(f"Error analyzing player logs: {e}")
-        return 0
+        logging.error(f"Error fetching container logs: {e}")
+        return None
+
+@dataclass
+class LogSnapshot:
+    """Resultado de analizar la cola del log del contenedor"""
+    active: bool
+    players: set = field(default_factory=set)
+    connection_events: int = 0
 
-def check_recent_player_activity(subscription_id, minutes_back=10):
+def analyze_logs(log_lines):
     """
-    Verifica si ha habido actividad de jugadores en los logs del contenedor
-    en los últimos X minutos
+    Analiza las líneas recientes del log con las regex precompiladas: estima los jugadores
+    conectados (siguiendo entradas y salidas en orden) y detecta actividad reciente
     """
+    if log_lines is None:
+        # En caso de error al leer los logs, ser conservador y asumir que hay actividad
+        return LogSnapshot(active=True)
+    
+    if not log_lines:
+        logging.warning("No logs available from container")
+        return LogSnapshot(active=False)
+    
     try:
-        credential = DefaultAzureCredential()
-        container_client = ContainerInstanceManagementClient(credential, subscription_id)
+        log_text = '\n'.join(log_lines)
         
-        # Obtener logs del contenedor (más líneas para mejor análisis)
-        logs = container_client.containers.list_logs(
-            resource_group_name=RESOURCE_GROUP,
-            container_group_name=CONTAINER_NAME,
-            container_name=CONTAINER_NAME,
-            tail=200
-        )
+        activity_lines = _ACTIVITY_LINE_RE.findall(log_text)
+        activity_count = len(activity_lines)
+        if activity_lines:
+            logging.info(f"Player activity found in logs: {activity_lines[0].strip()}")
         
-        if not logs or not logs.content:
-            logging.warning("No logs available from container")
-            return False
-        
-        log_lines = logs.content.split('\n')
-        
-        # Patrones específicos para servidores offline (itzg/minecraft-server)
-        activity_patterns = [
-            'joined the game',
-            'left the game', 
-            'logged in with entity id',
-            'lost connection',
-            '[Not Secure]',  # Chat messages en servidores offline
-            'issued server command',
-            'was slain',
-            'drowned',
-            'fell',
-            'has made the advancement',
-            'UUID of player',
-            'moving too quickly',
-            'tried to swim in lava',
-            'went up in flames',
-            'blew up',
-            'hit the ground too hard',
-            'was shot',
-            'was killed',
-            'starved to death',
-            'suffocated',
-            'experienced kinetic energy',
-            'fell out of the world',
-            'saving chunks',  # Indica actividad del servidor
-            'automatic saving',
-            'ThreadedAnvilChunkStorage'  # Actividad de guardado
-        ]
-        
-        # Buscar cualquier actividad reciente
-        recent_activity_found = False
-        activity_count = 0
-        
-        for line in log_lines[-50:]:  # Revisar las últimas 50 líneas más recientes
-            line_lower = line.lower()
-            if any(pattern.lower() in line_lower for pattern in activity_patterns):
-                activity_count += 1
-                if not recent_activity_found:
-                    logging.info(f"Player activity found in logs: {line.strip()}")
-                    recent_activity_found = True
+        # Las conexiones TCP solo se buscan en las últimas 30 líneas
+        connection_count = len(_CONNECTION_LINE_RE.findall('\n'.join(log_lines[-30:])))
+        
+        # Entradas y salidas en orden. Patrones comunes: "Player joined the game" o "[INFO]: Player joined the game"
+        connected_players = set()
+        for match in _PLAYER_EVENT_RE.finditer(log_text):
+            if match.group('join'):
+                connected_players.add(match.group(1))
+            else:
+                connected_players.discard(match.group(1))  # Remover si estaba conectado
+        
+        if connected_players:
+            logging.info(f"Estimated {len(connected_players)} players from logs: {list(connected_players)}")
         
         if activity_count > 0:
             logging.info(f"Total player activity events found in recent logs: {activity_count}")
-            return True
-        
-        # También buscar conexiones TCP recientes (indicativo de intentos de conexión)
-        connection_patterns = [
-            'connection',
-            'disconnect',
-            'timeout',
-            'handshake'
-        ]
-        
-        connection_count = 0
-        for line in log_lines[-30:]:  # Revisar conexiones en las últimas 30 líneas
-            line_lower = line.lower()
-            if any(pattern in line_lower for pattern in connection_patterns):
-                connection_count += 1
-        
-        if connection_count > 2:  # Múltiples eventos de conexión sugieren actividad
+            active = True
+        elif connection_count > 2:  # Múltiples eventos de conexión sugieren actividad
             logging.info(f"Recent connection activity detected: {connection_count} events")
-            return True
+            active = True
+        else:
+            logging.info("No recent player activity found in container logs")
+            active = False
         
-        logging.info("No recent player activity found in container logs")
-        return False
+        return LogSnapshot(active=active, players=connected_players, connection_events=connection_count)
         
     except Exception as e:
-        logging.error(f"Error checking container logs: {e}")
+        logging.error(f"Error analyzing container logs: {e}")
         # En caso de error, ser conservador y asumir que hay actividad
-        return True
+        return LogSnapshot(active=True)
 
-def get_container_info(subscription_id):
+async def get_container_info(subscription_id):
     """
     Obtiene información del contenedor de Minecraft
     """
     try:
-        credential = DefaultAzureCredential()
-        container_client = ContainerInstanceManagementClient(credential, subscription_id)
+        container_client = get_aci_client(subscription_id)
         
-        container = container_client.container_groups.get(RESOURCE_GROUP, CONTAINER_NAME)
+        container = await container_client.container_groups.get(RESOURCE_GROUP, CONTAINER_NAME)
         
         if container.instance_view and container.instance_view.state == "Running":
             ip_address = container.ip_address.ip if container.ip_address else None
@@ -442,17 +615,15 @@ def get_container_info(subscription_id):
         logging.error(f"Error getting container info: {e}")
         return None
 
-def stop_container(subscription_id):
+async def stop_container(subscription_id):
     """
     Detiene el contenedor de Minecraft
     """
     try:
-        credential = DefaultAzureCredential()
-        container_client = ContainerInstanceManagementClient(credential, subscription_id)
+        container_client = get_aci_client(subscription_id)
         
         logging.info(f"Stopping container {CONTAINER_NAME} in resource group {RESOURCE_GROUP}")
-        operation = container_client.container_groups.begin_stop(RESOURCE_GROUP, CONTAINER_NAME)
-        operation.wait()
+        await container_client.container_groups.stop(RESOURCE_GROUP, CONTAINER_NAME)
         
         logging.info("Container stopped successfully")
         return True
@@ -461,31 +632,53 @@ def stop_container(subscription_id):
         logging.error(f"Error stopping container: {e}")
         return False
 
-def get_table_client():
+async def get_table_client():
     """
-    Obtiene cliente de Azure Table Storage
+    Obtiene cliente de Azure Table Storage, creando la tabla la primera vez
     """
+    global _TABLE_CLIENT
+    if _TABLE_CLIENT is not None:
+        return _TABLE_CLIENT
+    
     try:
         connection_string = os.environ["AzureWebJobsStorage"]
-        table_service = TableServiceClient.from_connection_string(connection_string)
+        table_service = TableServiceClient.from_connection_string(connection_string, transport=get_http_transport())
         table_client = table_service.get_table_client("minecraftmonitor")
-        return table_client
     except Exception as e:
         logging.error(f"Error creating table client: {e}")
         return None
+    
+    # Crear tabla si no existe
+    try:
+        await table_client.create_table()
+    except:
+        pass  # Tabla ya existe
+    
+    _TABLE_CLIENT = table_client
+    return _TABLE_CLIENT
 
-def get_monitoring_state(table_client):
+async def get_monitoring_state(table_client):
     """
-    Obtiene el estado actual del monitoreo desde Table Storage
+    Obtiene el estado actual del monitoreo, desde memoria si la copia es reciente
+    o desde Table Storage si no
     """
+    if _STATE_CACHE.get("last_check_time"):
+        last_check = datetime.fromisoformat(_STATE_CACHE["last_check_time"])
+        if datetime.now(timezone.utc) - last_check < timedelta(minutes=2 * CHECK_INTERVAL_MINUTES):
+            return dict(_STATE_CACHE)
+    
     try:
-        entity = table_client.get_entity("state", "current")
-        return {
+        entity = await table_client.get_entity("state", "current")
+        state = {
             "last_players_seen": entity.get("last_players_seen"),
             "consecutive_empty_checks": entity.get("consecutive_empty_checks", 0),
             "consecutive_failures": entity.get("consecutive_failures", 0),
+            "last_successful_protocol": entity.get("last_successful_protocol"),
             "last_check_time": entity.get("last_check_time")
         }
+        _STATE_CACHE.clear()
+        _STATE_CACHE.update(state)
+        return state
     except:
         # Primera ejecución o entidad no existe
         return {
@@ -494,10 +687,18 @@ def get_monitoring_state(table_client):
             "last_check_time": None
         }
 
-def update_monitoring_state(table_client, state):
+async def update_monitoring_state(table_client, state):
     """
-    Actualiza el estado del monitoreo en Table Storage
+    Actualiza el estado del monitoreo en Table Storage, solo si cambió algún contador
+    o el protocolo; si no, basta con refrescar la copia en memoria
     """
+    now = datetime.now(timezone.utc).isoformat()
+    if _STATE_CACHE and all(state.get(name) == _STATE_CACHE.get(name) for name in _STATE_TRACKED_FIELDS):
+        _STATE_CACHE["last_players_seen"] = state["last_players_seen"]
+        _STATE_CACHE["last_check_time"] = now
+        logging.debug("Monitoring state unchanged, skipping Table Storage write")
+        return True
+    
     try:
         entity = TableEntity()
         entity["PartitionKey"] = "state"
@@ -505,9 +706,16 @@ def update_monitoring_state(table_client, state):
         entity["last_players_seen"] = state["last_players_seen"]
         entity["consecutive_empty_checks"] = state["consecutive_empty_checks"]
         entity["consecutive_failures"] = state.get("consecutive_failures", 0)
-        entity["last_check_time"] = datetime.now(timezone.utc).isoformat()
+        if state.get("last_successful_protocol"):
+            entity["last_successful_protocol"] = state["last_successful_protocol"]
+        entity["last_check_time"] = now
         
-        table_client.upsert_entity(entity)
+        await table_client.upsert_entity(entity)
+        
+        _STATE_CACHE.clear()
+        _STATE_CACHE.update(state)
+        _STATE_CACHE["consecutive_failures"] = entity["consecutive_failures"]
+        _STATE_CACHE["last_check_time"] = now
         return True
     except Exception as e:
         logging.error(f"Error updating monitoring state: {e}")
@@ -515,7 +723,7 @@ def update_monitoring_state(table_client, state):
 
 @app.timer_trigger(schedule="0 */3 * * * *", arg_name="myTimer", run_on_startup=False,
                    use_monitor=False) 
-def minecraft_monitor(myTimer: func.TimerRequest) -> None:
+async def minecraft_monitor(myTimer: func.TimerRequest) -> None:
     """
     Función principal que se ejecuta cada 3 minutos para monitorear el servidor
     """
@@ -528,22 +736,16 @@ def minecraft_monitor(myTimer: func.TimerRequest) -> None:
         return
     
     # Obtener cliente de tabla
-    table_client = get_table_client()
+    table_client = await get_table_client()
     if not table_client:
         logging.error("Could not create table client")
         return
     
-    # Crear tabla si no existe
-    try:
-        table_client.create_table()
-    except:
-        pass  # Tabla ya existe
-    
-    # Obtener estado actual
-    state = get_monitoring_state(table_client)
-    
-    # Obtener información del contenedor
-    container_info = get_container_info(subscription_id)
+    # Obtener estado actual e información del contenedor en paralelo
+    state, container_info = await asyncio.gather(
+        get_monitoring_state(table_client),
+        get_container_info(subscription_id)
+    )
     if not container_info:
         logging.error("Could not get container information")
         return
@@ -560,17 +762,22 @@ def minecraft_monitor(myTimer: func.TimerRequest) -> None:
     
     # Para servidores offline, intentar protocolo pero depender principalmente de logs
     logging.info(f"Attempting to connect to Minecraft server at {container_info['ip_address']}:{MINECRAFT_PORT}")
-    player_count = get_minecraft_player_count(container_info["ip_address"], MINECRAFT_PORT)
+    player_count = await asyncio.to_thread(
+        get_minecraft_player_count, container_info["ip_address"], MINECRAFT_PORT, state=state
+    )
     
-    # Verificar actividad en logs (método principal para servidores offline)
-    recent_activity = check_recent_player_activity(subscription_id, minutes_back=5)
-    current_players_from_logs = get_current_players_from_logs(subscription_id)
+    # Los logs solo se descargan cuando hacen falta: sin respuesta del protocolo o antes de apagar
+    log_snapshot = None
     
     if player_count == -1:
         logging.info("Server protocol not responding (likely offline-mode server)")
         
+        # Verificar actividad en logs (método principal para servidores offline)
+        log_snapshot = analyze_logs(await get_container_logs(subscription_id))
+        current_players_from_logs = len(log_snapshot.players)
+        
         # Para servidores offline, usar logs como fuente principal
-        if recent_activity or current_players_from_logs > 0:
+        if current_players_from_logs > 0 or log_snapshot.active:
             logging.info(f"Player activity detected in logs: {current_players_from_logs} players estimated")
             player_count = current_players_from_logs
             state["consecutive_failures"] = 0
@@ -588,7 +795,7 @@ def minecraft_monitor(myTimer: func.TimerRequest) -> None:
                 state["consecutive_failures"] = 0
             else:
                 # Actualizar estado pero no continuar con lógica de apagado
-                update_monitoring_state(table_client, state)
+                await update_monitoring_state(table_client, state)
                 return
     else:
         # Protocolo funcionó (servidor online-mode)
@@ -612,16 +819,17 @@ def minecraft_monitor(myTimer: func.TimerRequest) -> None:
         if state["consecutive_empty_checks"] >= 2:  # 2 checks * 3 minutos = 6 minutos
             logging.info(f"Server has been empty for {state['consecutive_empty_checks'] * 3} minutes.")
             
-            # Verificación final de actividad antes del apagado
-            final_activity_check = check_recent_player_activity(subscription_id, minutes_back=10)
-            if final_activity_check:
+            # Verificación final de actividad antes del apagado (reutiliza los logs si ya se leyeron)
+            if log_snapshot is None:
+                log_snapshot = analyze_logs(await get_container_logs(subscription_id))
+            if log_snapshot.active:
                 logging.info("Final activity check found recent player activity. Postponing shutdown.")
                 state["consecutive_empty_checks"] = 0  # Resetear contador
                 state["last_players_seen"] = datetime.now(timezone.utc).isoformat()
             else:
                 logging.info("Final activity check confirmed no recent activity. Proceeding with shutdown...")
                 
-                if stop_container(subscription_id):
+                if await stop_container(subscription_id):
                     logging.info("Container shutdown initiated successfully")
                     # Resetear estado después del apagado exitoso
                     state["consecutive_empty_checks"] = 0
@@ -634,6 +842,6 @@ def minecraft_monitor(myTimer: func.TimerRequest) -> None:
             logging.info(f"Server will shutdown in {minutes_until_shutdown} minutes if no players join")
     
     # Actualizar estado en storage
-    update_monitoring_state(table_client, state)
+    await update_monitoring_state(table_client, state)
     
     logging.info('Minecraft monitor function completed')